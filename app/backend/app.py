@@ -12,129 +12,349 @@ import time
 import random
 import os
 import json
-from datetime import datetime
-from collections import defaultdict
-from flask import Flask, jsonify, request
+import atexit
+import queue
+import sys
+import logging
+import logging.handlers
+from collections import Counter, defaultdict
+from flask import Flask, g, jsonify, request
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+import orjson
+from prometheus_client import CONTENT_TYPE_LATEST
 import psutil
 import threading
 import redis
 
+
+class ORJSONProvider(JSONProvider):
+    """JSON provider that serializes responses with orjson"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Hand orjson's bytes straight to the response, skipping a decode
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype="application/json")
+
+
+# Artificial processing delays in the demo endpoints (SIMULATE_LATENCY=0 disables)
+SIMULATE_LATENCY = os.getenv("SIMULATE_LATENCY", "1") == "1"
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 CORS(app)  # Enable CORS for frontend communication
 
 
-# Redis connection for shared metrics
+# Access log - records are formatted and written on a background thread
+def get_access_logger():
+    """Get a logger that hands records to a QueueListener instead of stdout"""
+    formatter = logging.Formatter(
+        "%(asctime)s.%(msecs)03dZ - %(message)s", datefmt="%Y-%m-%dT%H:%M:%S"
+    )
+    formatter.converter = time.gmtime
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    logger = logging.getLogger("access")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    return logger
+
+
+access_logger = get_access_logger()
+
+# Response timestamp, formatted at most once per second
+_timestamp_cache = (None, "")
+
+
+def now_iso():
+    """Get the current UTC time as an ISO 8601 string with second precision"""
+    global _timestamp_cache
+    second, stamp = _timestamp_cache
+    now = int(time.time())
+    if now != second:
+        stamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now))
+        _timestamp_cache = (now, stamp)
+    return stamp
+
+
+# Redis connection pool for shared metrics
 def get_redis_client():
-    """Get Redis client with error handling"""
-    try:
-        redis_host = os.getenv("REDIS_HOST", "localhost")
-        redis_port = int(os.getenv("REDIS_PORT", 6379))
-        client = redis.Redis(
-            host=redis_host, port=redis_port, decode_responses=True, socket_timeout=1
-        )
-        client.ping()  # Test connection
-        return client
-    except Exception as e:
-        print(f"Redis connection failed: {e}")
-        return None
+    """Get a Redis client backed by a thread-safe blocking connection pool"""
+    pool = redis.BlockingConnectionPool(
+        host=os.getenv("REDIS_HOST", "localhost"),
+        port=int(os.getenv("REDIS_PORT", 6379)),
+        max_connections=int(os.getenv("REDIS_POOL_SIZE", 32)),
+        socket_timeout=1,
+        socket_keepalive=True,
+        decode_responses=True,
+    )
+    return redis.Redis(connection_pool=pool)
 
 
 redis_client = get_redis_client()
+redis_healthy = threading.Event()
+
+
+def check_redis_health(interval=5):
+    """Ping Redis periodically so health checks never block on it"""
+    while True:
+        try:
+            redis_client.ping()
+            redis_healthy.set()
+        except redis.RedisError as e:
+            if redis_healthy.is_set():
+                print(f"❌ Redis health check failed: {e}")
+            redis_healthy.clear()
+        time.sleep(interval)
+
+
+threading.Thread(target=check_redis_health, name="redis-health", daemon=True).start()
+
+
+# Process handle and pid, looked up once; system stats refreshed once per TTL
+_process = psutil.Process()
+# Workers import the app after gunicorn forks, so this is each worker's own pid
+_worker_id = os.getpid()
+_system_stats = (float("-inf"), {})
+
+
+def get_system_stats(ttl=1.0):
+    """Get process and host resource usage, cached for ttl seconds"""
+    global _system_stats
+    timestamp, stats = _system_stats
+    now = time.monotonic()
+    if now - timestamp >= ttl:
+        stats = {
+            "memory_usage_mb": _process.memory_info().rss / 1024 / 1024,
+            "cpu_percent": psutil.cpu_percent(),
+            "system_memory_percent": psutil.virtual_memory().percent,
+            "disk_percent": psutil.disk_usage("/").percent,
+        }
+        _system_stats = (now, stats)
+    return stats
+
+
+# Endpoints that are not counted as application traffic
+_IGNORED_ENDPOINTS = frozenset({"static", "prometheus_metrics", "metrics_json"})
+
+# Applies one batch of requests atomically, so scrapes never see a partial batch.
+# KEYS[5] is the prefix for per-status-code error counters.
+# ARGV: request count, response time sum (ms), error count, number of status
+# codes, then status code/count pairs, then endpoint/count pairs.
+RECORD_BATCH_SCRIPT = """
+redis.call('INCRBY', KEYS[1], ARGV[1])
+redis.call('INCRBYFLOAT', KEYS[2], ARGV[2])
+redis.call('INCRBY', KEYS[3], ARGV[1])
+if tonumber(ARGV[3]) > 0 then
+    redis.call('INCRBY', KEYS[4], ARGV[3])
+end
+local i = 5
+for _ = 1, tonumber(ARGV[4]) do
+    redis.call('INCRBY', KEYS[5] .. ARGV[i], ARGV[i + 1])
+    i = i + 2
+end
+while i < #ARGV do
+    redis.call('HINCRBY', KEYS[6], ARGV[i], ARGV[i + 1])
+    i = i + 2
+end
+"""
+
+RECORD_BATCH_KEYS = [
+    "app:requests_total",
+    "app:rt_sum",
+    "app:rt_count",
+    "app:errors_total",
+    "app:errors_",
+    "app:endpoints",
+]
+
+# Requests waiting to be written to Redis by the background flusher
+_metrics_queue = queue.SimpleQueue()
+_flush_lock = threading.Lock()
 
 
 class MetricsCollector:
     """
     Redis-only metrics collector for shared storage across multiple workers.
     Requires Redis to be available - fails fast if Redis is unavailable.
-    """
 
-    _instance = None
-    _lock = threading.Lock()
-
-    def __new__(cls):
-        if cls._instance is None:
-            with cls._lock:
-                if cls._instance is None:
-                    cls._instance = super().__new__(cls)
-                    cls._instance._initialized = False
-        return cls._instance
-
-    def __init__(self):
-        if self._initialized:
-            return
+    Requests are queued in memory and written to Redis in batches by a
+    background thread, so Redis latency stays off the request path.
+    """
 
+    def __init__(self, flush_interval=0.05, flush_batch_size=500):
         self.start_time = time.time()
+        self.flush_interval = flush_interval
+        self.flush_batch_size = flush_batch_size
 
-        # Require Redis - fail fast if unavailable
-        if redis_client is None:
+        # Initialize Redis keys if they don't exist - fail fast if unavailable
+        try:
+            if not redis_client.exists("app:start_time"):
+                redis_client.set("app:start_time", self.start_time)
+            self._migrate_endpoint_keys()
+            # Response times are kept as a running sum and count; UNLINK frees
+            # the old sample list without blocking Redis
+            redis_client.unlink("app:response_times")
+        except redis.RedisError as e:
             raise RuntimeError(
-                "❌ Redis is required but unavailable. "
+                f"❌ Redis is required but unavailable: {e}. "
                 "Please ensure Redis is running and accessible."
             )
 
-        # Initialize Redis keys if they don't exist
-        if not redis_client.exists("app:start_time"):
-            redis_client.set("app:start_time", self.start_time)
+        # Sent with EVALSHA; redis-py reloads the script if Redis lost it
+        self._record_batch = redis_client.register_script(RECORD_BATCH_SCRIPT)
+
+        # Flush queued requests in the background
+        self._stopped = threading.Event()
+        self._flusher = threading.Thread(
+            target=self._flush_loop, name="metrics-flusher", daemon=True
+        )
+        self._flusher.start()
+        atexit.register(self.stop)
 
         print("✅ Using Redis for metrics storage")
-        self._initialized = True
+
+    def _migrate_endpoint_keys(self):
+        """Fold per-endpoint counter keys from older releases into the hash."""
+        # SCAN walks the keyspace incrementally instead of blocking like KEYS
+        keys = list(redis_client.scan_iter(match="app:endpoint:*:requests", count=500))
+        if not keys:
+            return
+
+        # GETDEL hands each counter to exactly one worker, even when several
+        # workers start at the same time
+        pipe = redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.getdel(key)
+        counts = pipe.execute()
+
+        pipe = redis_client.pipeline(transaction=False)
+        for key, count in zip(keys, counts):
+            if count is not None:
+                endpoint = key[len("app:endpoint:") : -len(":requests")]
+                pipe.hincrby("app:endpoints", endpoint, int(count))
+        pipe.execute()
 
     def record_request(self, endpoint, duration, success=True, status_code=200):
-        """Record a request using Redis for shared storage."""
-        try:
-            # Atomic operations in Redis
-            redis_client.incr("app:requests_total")
-            redis_client.lpush("app:response_times", duration * 1000)  # Store in ms
-            redis_client.ltrim("app:response_times", 0, 999)  # Keep last 1000
+        """Queue a request to be recorded in Redis by the background flusher."""
+        # Unrouted requests (404s) and the metrics endpoints themselves
+        if endpoint is None or endpoint in _IGNORED_ENDPOINTS:
+            return
+        _metrics_queue.put((endpoint, duration, success, status_code))
 
+    def flush(self):
+        """Write all queued requests to Redis."""
+        with _flush_lock:
+            while True:
+                batch = []
+                try:
+                    while len(batch) < self.flush_batch_size:
+                        batch.append(_metrics_queue.get_nowait())
+                except queue.Empty:
+                    pass
+
+                if batch:
+                    self._write_batch(batch)
+                if len(batch) < self.flush_batch_size:
+                    return
+
+    def stop(self):
+        """Stop the background flusher and write any remaining requests."""
+        self._stopped.set()
+        self._flusher.join()
+        try:
+            self.flush()
+        except RuntimeError:
+            pass  # Already logged
+
+    def _flush_loop(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except RuntimeError:
+                pass  # Already logged; the failed batch is dropped
+
+    def _write_batch(self, batch):
+        # Collapse the batch into a single update per key
+        rt_sum = 0.0
+        errors = Counter()
+        endpoints = Counter()
+        for endpoint, duration, success, status_code in batch:
+            rt_sum += duration
             if not success or status_code >= 400:
-                redis_client.incr("app:errors_total")
-                redis_client.incr(
-                    f"app:errors_{status_code}"
-                )  # Track specific error codes
+                errors[status_code] += 1
+            endpoints[endpoint] += 1
 
-            # Store endpoint-specific metrics
-            redis_client.incr(f"app:endpoint:{endpoint}:requests")
+        args = [len(batch), rt_sum * 1000, sum(errors.values()), len(errors)]
+        for status_code, count in errors.items():
+            args += [status_code, count]
+        for endpoint, count in endpoints.items():
+            args += [endpoint, count]
+
+        try:
+            # One command and one round-trip for the whole batch
+            self._record_batch(keys=RECORD_BATCH_KEYS, args=args)
         except Exception as e:
-            print(f"❌ Redis error in record_request: {e}")
-            # Re-raise to fail fast rather than silently continue
+            print(f"❌ Redis error in flush: {e}")
             raise RuntimeError(f"Redis operation failed: {e}")
 
     def get_metrics(self):
         """Get current metrics from Redis."""
         try:
-            # Get metrics from Redis
-            requests_total = int(redis_client.get("app:requests_total") or 0)
-            errors_total = int(redis_client.get("app:errors_total") or 0)
-
-            # Get error breakdown by status code
-            errors_400 = int(redis_client.get("app:errors_400") or 0)
-            errors_500 = int(redis_client.get("app:errors_500") or 0)
-
-            # Get response times and calculate average
-            response_times_raw = redis_client.lrange("app:response_times", 0, -1)
-            response_times = [float(x) for x in response_times_raw if x]
-            response_time_avg = (
-                sum(response_times) / len(response_times) if response_times else 0
-            )
+            # Fetch everything in a single round-trip
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.get("app:requests_total")
+            pipe.get("app:errors_total")
+            pipe.get("app:errors_400")  # Error breakdown by status code
+            pipe.get("app:errors_500")
+            pipe.get("app:start_time")
+            pipe.get("app:rt_sum")
+            pipe.get("app:rt_count")
+            pipe.hgetall("app:endpoints")
+            (
+                requests_total,
+                errors_total,
+                errors_400,
+                errors_500,
+                app_start_time,
+                rt_sum,
+                rt_count,
+                endpoints_raw,
+            ) = pipe.execute()
+
+            requests_total = int(requests_total or 0)
+            errors_total = int(errors_total or 0)
+            errors_400 = int(errors_400 or 0)
+            errors_500 = int(errors_500 or 0)
+
+            # Calculate average response time
+            rt_sum = float(rt_sum or 0)
+            rt_count = int(rt_count or 0)
+            response_time_avg = rt_sum / rt_count if rt_count else 0
 
             # Get endpoint-specific metrics
-            endpoint_metrics = {}
-            for key in redis_client.keys("app:endpoint:*:requests"):
-                try:
-                    endpoint = key.split(":")[2]  # Extract endpoint name
-                    count = int(redis_client.get(key) or 0)
-                    endpoint_metrics[endpoint] = count
-                except (IndexError, ValueError):
-                    continue
-
-            # Get app start time from Redis
-            app_start_time = float(
-                redis_client.get("app:start_time") or self.start_time
-            )
+            endpoint_metrics = {
+                endpoint: int(count) for endpoint, count in endpoints_raw.items()
+            }
+
+            app_start_time = float(app_start_time or self.start_time)
             uptime = time.time() - app_start_time
 
+            system_stats = get_system_stats()
+
             return {
                 "requests_total": requests_total,
                 "errors_total": errors_total,
@@ -142,10 +362,10 @@ class MetricsCollector:
                 "errors_500": errors_500,
                 "uptime": uptime,
                 "response_time_avg": response_time_avg,
-                "memory_usage_mb": psutil.Process().memory_info().rss / 1024 / 1024,
-                "cpu_percent": psutil.cpu_percent(),
+                "memory_usage_mb": system_stats["memory_usage_mb"],
+                "cpu_percent": system_stats["cpu_percent"],
                 "storage_type": "redis",
-                "worker_id": os.getpid(),
+                "worker_id": _worker_id,
                 "endpoint_metrics": endpoint_metrics,
             }
 
@@ -155,7 +375,7 @@ class MetricsCollector:
             raise RuntimeError(f"Redis operation failed: {e}")
 
 
-# Create metrics instance
+# Create the metrics instance shared by all requests in this worker
 metrics = MetricsCollector()
 
 
@@ -189,6 +409,8 @@ def track_metrics(func):
         finally:
             duration = time.time() - start_time
             metrics.record_request(request.endpoint, duration, success, status_code)
+            # Tells handle_exception this request has already been counted
+            g.metrics_recorded = True
 
     wrapper.__name__ = func.__name__
     return wrapper
@@ -198,18 +420,19 @@ def track_metrics(func):
 @track_metrics
 def health_check():
     """Health check endpoint for Kubernetes liveness/readiness probes"""
+    system_stats = get_system_stats()
     health_status = {
         "status": "healthy",
-        "timestamp": datetime.utcnow().isoformat(),
+        "timestamp": now_iso(),
         "version": "1.0.0",
         "uptime": time.time() - metrics.start_time,
-        "worker_id": os.getpid(),
-        "redis_connected": redis_client is not None,
+        "worker_id": _worker_id,
+        "redis_connected": redis_healthy.is_set(),
         "checks": {
             "database": "ok",  # Placeholder - would check real DB
-            "memory": "ok" if psutil.virtual_memory().percent < 90 else "warning",
-            "disk": "ok" if psutil.disk_usage("/").percent < 90 else "warning",
-            "redis": "ok" if redis_client else "disconnected",
+            "memory": "ok" if system_stats["system_memory_percent"] < 90 else "warning",
+            "disk": "ok" if system_stats["disk_percent"] < 90 else "warning",
+            "redis": "ok" if redis_healthy.is_set() else "disconnected",
         },
     }
 
@@ -221,55 +444,84 @@ def health_check():
     return jsonify(health_status)
 
 
-@app.route("/metrics")
-def prometheus_metrics():
-    """Prometheus metrics endpoint in the expected format"""
-    current_metrics = metrics.get_metrics()
-
-    # Prometheus format metrics
-    metrics_output = f"""# HELP requests_total Total number of requests
+# Prometheus exposition format - only the sample values change between scrapes
+PROMETHEUS_TEMPLATE = b"""# HELP requests_total Total number of requests
 # TYPE requests_total counter
-requests_total {current_metrics.get('requests_total', 0)}
+requests_total %d
 
 # HELP errors_total Total number of errors
 # TYPE errors_total counter
-errors_total {current_metrics.get('errors_total', 0)}
+errors_total %d
 
 # HELP errors_by_status_code Error count by HTTP status code
 # TYPE errors_by_status_code counter
-errors_by_status_code{{code="400"}} {current_metrics.get('errors_400', 0)}
-errors_by_status_code{{code="500"}} {current_metrics.get('errors_500', 0)}
+errors_by_status_code{code="400"} %d
+errors_by_status_code{code="500"} %d
 
 # HELP response_time_avg Average response time in milliseconds
 # TYPE response_time_avg gauge
-response_time_avg {current_metrics.get('response_time_avg', 0)}
+response_time_avg %r
 
 # HELP memory_usage_mb Memory usage in megabytes
 # TYPE memory_usage_mb gauge
-memory_usage_mb {current_metrics.get('memory_usage_mb', 0)}
+memory_usage_mb %r
 
 # HELP cpu_percent CPU usage percentage
 # TYPE cpu_percent gauge
-cpu_percent {current_metrics.get('cpu_percent', 0)}
+cpu_percent %r
 
 # HELP uptime_seconds Application uptime in seconds
 # TYPE uptime_seconds gauge
-uptime_seconds {current_metrics.get('uptime', 0)}
+uptime_seconds %r
 
 # HELP app_info Application information
 # TYPE app_info gauge
-app_info{{worker_id="{current_metrics.get('worker_id', 'unknown')}", storage="{current_metrics.get('storage_type', 'unknown')}"}} 1
+app_info{worker_id="%d", storage="%s"} 1
 """
 
+PROMETHEUS_ENDPOINT_HEADER = b"""
+
+# HELP requests_by_endpoint Requests per endpoint
+# TYPE requests_by_endpoint counter
+"""
+
+PROMETHEUS_ENDPOINT_SAMPLE = b'requests_by_endpoint{endpoint="%s"} %d\n'
+
+
+@app.route("/metrics")
+def prometheus_metrics():
+    """Prometheus metrics endpoint in the expected format"""
+    current_metrics = metrics.get_metrics()
+
+    # %r renders floats exactly as str() does
+    metrics_output = PROMETHEUS_TEMPLATE % (
+        current_metrics["requests_total"],
+        current_metrics["errors_total"],
+        current_metrics["errors_400"],
+        current_metrics["errors_500"],
+        current_metrics["response_time_avg"],
+        current_metrics["memory_usage_mb"],
+        current_metrics["cpu_percent"],
+        current_metrics["uptime"],
+        current_metrics["worker_id"],
+        current_metrics["storage_type"].encode(),
+    )
+
     # Add endpoint-specific metrics if available
-    endpoint_metrics = current_metrics.get("endpoint_metrics", {})
+    endpoint_metrics = current_metrics["endpoint_metrics"]
     if endpoint_metrics:
-        metrics_output += "\n\n# HELP requests_by_endpoint Requests per endpoint\n"
-        metrics_output += "# TYPE requests_by_endpoint counter\n"
-        for endpoint, count in endpoint_metrics.items():
-            metrics_output += f'requests_by_endpoint{{endpoint="{endpoint}"}} {count}\n'
+        metrics_output = b"".join(
+            [
+                metrics_output,
+                PROMETHEUS_ENDPOINT_HEADER,
+                *(
+                    PROMETHEUS_ENDPOINT_SAMPLE % (endpoint.encode(), count)
+                    for endpoint, count in endpoint_metrics.items()
+                ),
+            ]
+        )
 
-    return metrics_output, 200, {"Content-Type": "text/plain; charset=utf-8"}
+    return metrics_output, 200, {"Content-Type": CONTENT_TYPE_LATEST}
 
 
 @app.route("/metrics-json")
@@ -283,12 +535,13 @@ def metrics_json():
 def get_data():
     """Sample API endpoint that returns some data"""
     # Simulate some processing time
-    time.sleep(random.uniform(0.01, 0.1))
+    if SIMULATE_LATENCY:
+        time.sleep(random.uniform(0.01, 0.1))
 
     return jsonify(
         {
             "message": "Hello from the backend!",
-            "timestamp": datetime.utcnow().isoformat(),
+            "timestamp": now_iso(),
             "random_number": random.randint(1, 1000),
             "server_info": {
                 "python_version": "3.x",
@@ -304,7 +557,7 @@ def get_data():
 def load_test():
     """Endpoint for generating test load"""
     # Simulate variable processing time
-    delay = random.uniform(0.1, 2.0)
+    delay = random.uniform(0.1, 2.0) if SIMULATE_LATENCY else 0.0
     time.sleep(delay)
 
     # Simulate different outcomes
@@ -316,7 +569,7 @@ def load_test():
                 {
                     "status": "success",
                     "delay": delay,
-                    "timestamp": datetime.utcnow().isoformat(),
+                    "timestamp": now_iso(),
                 }
             ),
             200,
@@ -326,7 +579,7 @@ def load_test():
             jsonify(
                 {
                     "error": "Simulated client error",
-                    "timestamp": datetime.utcnow().isoformat(),
+                    "timestamp": now_iso(),
                 }
             ),
             400,
@@ -336,7 +589,7 @@ def load_test():
             jsonify(
                 {
                     "error": "Simulated server error",
-                    "timestamp": datetime.utcnow().isoformat(),
+                    "timestamp": now_iso(),
                 }
             ),
             500,
@@ -346,14 +599,16 @@ def load_test():
 @app.errorhandler(Exception)
 def handle_exception(e):
     """Global error handler"""
-    metrics.record_request(
-        request.endpoint if request.endpoint else "unknown", 0, False
-    )
+    # Views wrapped in track_metrics have already recorded their own failure.
+    # Recording only queues the request, so the error path never waits on Redis
+    if not g.get("metrics_recorded"):
+        duration = time.time() - getattr(request, "start_time", time.time())
+        metrics.record_request(request.endpoint, duration, False, 500)
     return (
         jsonify(
             {
                 "error": "Internal server error",
-                "timestamp": datetime.utcnow().isoformat(),
+                "timestamp": now_iso(),
                 "type": type(e).__name__,
             }
         ),
@@ -372,8 +627,12 @@ def after_request(response):
     """Log response details"""
     if hasattr(request, "start_time"):
         duration = time.time() - request.start_time
-        print(
-            f"{datetime.utcnow().isoformat()} - {request.method} {request.path} - {response.status_code} - {duration:.3f}s"
+        access_logger.info(
+            "%s %s - %d - %.3fs",
+            request.method,
+            request.path,
+            response.status_code,
+            duration,
         )
     return response
 
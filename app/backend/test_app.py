@@ -1,83 +1,133 @@
 # Basic test file for the Flask backend
 import pytest
 import json
+import fnmatch
+import os
 import threading
+import redis
 from unittest.mock import MagicMock, patch
 
 
+class MockPipeline:
+    """Mock Redis pipeline that buffers commands until execute()"""
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+
+        return queue
+
+    def execute(self):
+        results = [method(*args, **kwargs) for method, args, kwargs in self.commands]
+        self.commands = []
+        return results
+
+
+class MockScript:
+    """Mock of the metrics batch Lua script, applied with MockRedis commands"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def __call__(self, keys, args):
+        requests_total, rt_sum, rt_count, errors_total, errors_prefix, endpoints = keys
+        self.client.incrby(requests_total, args[0])
+        self.client.incrbyfloat(rt_sum, args[1])
+        self.client.incrby(rt_count, args[0])
+        if args[2] > 0:
+            self.client.incrby(errors_total, args[2])
+        codes_end = 4 + 2 * args[3]
+        for i in range(4, codes_end, 2):
+            self.client.incrby(f"{errors_prefix}{args[i]}", args[i + 1])
+        for i in range(codes_end, len(args), 2):
+            self.client.hincrby(endpoints, args[i], args[i + 1])
+
+
 # Mock Redis for testing
 class MockRedis:
     """Mock Redis client for testing"""
 
     def __init__(self):
         self.data = {}
-        self.lists = {}
+        self.hashes = {}
 
     def ping(self):
         return True
 
+    def pipeline(self, transaction=True):
+        return MockPipeline(self)
+
+    def register_script(self, script):
+        return MockScript(self)
+
     def get(self, key):
         return self.data.get(key)
 
     def set(self, key, value):
         self.data[key] = str(value)
 
-    def incr(self, key):
+    def incr(self, key, amount=1):
         current = int(self.data.get(key, 0))
-        self.data[key] = str(current + 1)
-        return current + 1
+        self.data[key] = str(current + amount)
+        return current + amount
+
+    incrby = incr
+
+    def incrbyfloat(self, key, amount):
+        current = float(self.data.get(key, 0))
+        self.data[key] = str(current + amount)
+        return current + amount
+
+    def unlink(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def getdel(self, key):
+        return self.data.pop(key, None)
+
+    def scan_iter(self, match=None, count=None):
+        return [k for k in list(self.data) if fnmatch.fnmatchcase(k, match or "*")]
 
     def exists(self, key):
         return key in self.data
 
-    def lpush(self, key, value):
-        if key not in self.lists:
-            self.lists[key] = []
-        self.lists[key].insert(0, str(value))
-
-    def ltrim(self, key, start, end):
-        if key in self.lists:
-            if end == -1:
-                self.lists[key] = self.lists[key][start:]
-            else:
-                self.lists[key] = self.lists[key][start : end + 1]
-
-    def lrange(self, key, start, end):
-        if key not in self.lists:
-            return []
-        if end == -1:
-            return self.lists[key][start:]
-        else:
-            return self.lists[key][start : end + 1]
-
-    def keys(self, pattern):
-        # Simple pattern matching for our test case
-        if pattern == "app:endpoint:*:requests":
-            return [
-                k
-                for k in self.data.keys()
-                if k.startswith("app:endpoint:") and k.endswith(":requests")
-            ]
-        return []
+    def hincrby(self, key, field, amount=1):
+        if key not in self.hashes:
+            self.hashes[key] = {}
+        current = int(self.hashes[key].get(field, 0))
+        self.hashes[key][field] = str(current + amount)
+        return current + amount
+
+    def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
 
 
 # Mock Redis before importing app
 mock_redis_client = MockRedis()
 
+# Skip the demo endpoints' artificial delays
+os.environ["SIMULATE_LATENCY"] = "0"
+
 # Patch Redis before app import
 with patch("redis.Redis") as mock_redis_class:
     mock_redis_class.return_value = mock_redis_client
-    from app import app, MetricsCollector
+    import app as app_module
+    from app import app, MetricsCollector, metrics
 
 
 @pytest.fixture(autouse=True)
 def reset_metrics():
-    """Reset metrics singleton for each test"""
-    # Reset singleton instance for each test
-    MetricsCollector._instance = None
-    # Clear mock Redis data
+    """Reset metrics for each test"""
+    # Write out requests queued by earlier tests, then clear mock Redis data
+    metrics.flush()
     mock_redis_client.data.clear()
-    mock_redis_client.lists.clear()
+    mock_redis_client.hashes.clear()
     yield
 
 
@@ -89,24 +139,16 @@ def client():
         yield client
 
 
-def test_singleton_pattern():
-    """Test that MetricsCollector implements Singleton pattern correctly."""
-    # Create multiple instances
-    metrics1 = MetricsCollector()
-    metrics2 = MetricsCollector()
-
-    # They should be the same object
-    assert metrics1 is metrics2
-
-    # Test that data is shared through Redis
-    metrics1.record_request("/test", 0.1, True)
-    metrics_data = metrics2.get_metrics()
+def test_shared_metrics():
+    """Test that requests recorded by the app show up in its metrics."""
+    metrics.record_request("/test", 0.1, True)
+    metrics.flush()
+    metrics_data = metrics.get_metrics()
     assert metrics_data["requests_total"] >= 1
 
 
 def test_thread_safety():
     """Test that MetricsCollector is thread-safe through Redis."""
-    metrics = MetricsCollector()
     initial_count = metrics.get_metrics()["requests_total"]
 
     def make_requests():
@@ -125,10 +167,105 @@ def test_thread_safety():
         thread.join()
 
     # Should have 30 additional requests (3 threads × 10 requests each)
+    metrics.flush()
     final_count = metrics.get_metrics()["requests_total"]
     assert final_count == initial_count + 30
 
 
+def test_record_request_is_queued():
+    """Test that recording a request does not wait on Redis."""
+    with patch.object(
+        metrics, "_record_batch", side_effect=redis.ConnectionError("down")
+    ):
+        # Must not raise even though Redis is unavailable
+        metrics.record_request("/test", 0.01, True)
+
+
+def test_endpoint_metrics():
+    """Test that requests are counted per endpoint."""
+    metrics.record_request("health_check", 0.01, True)
+    metrics.record_request("health_check", 0.01, True)
+    metrics.record_request("get_data", 0.01, True)
+    metrics.flush()
+
+    endpoint_metrics = metrics.get_metrics()["endpoint_metrics"]
+    assert endpoint_metrics == {"health_check": 2, "get_data": 1}
+
+
+def test_legacy_keys_migrated():
+    """Test that keys from older releases are migrated or removed."""
+    mock_redis_client.set("app:endpoint:get_data:requests", 5)
+    mock_redis_client.set("app:response_times", "legacy sample list")
+    mock_redis_client.hincrby("app:endpoints", "get_data", 2)
+
+    collector = MetricsCollector()
+    collector.stop()
+
+    assert mock_redis_client.get("app:endpoint:get_data:requests") is None
+    assert not mock_redis_client.exists("app:response_times")
+    assert metrics.get_metrics()["endpoint_metrics"] == {"get_data": 7}
+
+
+def test_ignored_endpoints_not_recorded(client):
+    """Test that unrouted and metrics requests are not counted."""
+    metrics.record_request(None, 0.01, False, 404)
+    metrics.record_request("prometheus_metrics", 0.01, True)
+    client.get("/metrics-json")
+    client.get("/metrics")
+    metrics.flush()
+
+    metrics_data = metrics.get_metrics()
+    assert metrics_data["requests_total"] == 0
+    assert metrics_data["endpoint_metrics"] == {}
+
+
+def test_response_time_average():
+    """Test that the average response time is reported in milliseconds."""
+    metrics.record_request("get_data", 0.01, True)
+    metrics.record_request("get_data", 0.03, True)
+    metrics.flush()
+
+    assert metrics.get_metrics()["response_time_avg"] == pytest.approx(20.0)
+
+
+def test_error_metrics():
+    """Test that errors are counted in total and by status code."""
+    metrics.record_request("load_test", 0.01, False, 400)
+    metrics.record_request("load_test", 0.01, False, 500)
+    metrics.record_request("load_test", 0.01, False, 500)
+    metrics.record_request("load_test", 0.01, True)
+    metrics.flush()
+
+    metrics_data = metrics.get_metrics()
+    assert metrics_data["requests_total"] == 4
+    assert metrics_data["errors_total"] == 3
+    assert metrics_data["errors_400"] == 1
+    assert metrics_data["errors_500"] == 2
+
+
+def test_system_stats_are_cached():
+    """Test that system stats are only sampled once per TTL."""
+    with patch("app.psutil.cpu_percent", return_value=12.5) as cpu_percent:
+        app_module._system_stats = (float("-inf"), {})
+        first = app_module.get_system_stats(ttl=60)
+        second = app_module.get_system_stats(ttl=60)
+
+    assert first is second
+    assert first["cpu_percent"] == 12.5
+    assert cpu_percent.call_count == 1
+
+
+def test_now_iso():
+    """Test that timestamps are ISO 8601 UTC and cached per second."""
+    with patch("app.time.time", return_value=1700000000.25):
+        first = app_module.now_iso()
+    with patch("app.time.time", return_value=1700000000.75):
+        second = app_module.now_iso()
+
+    assert first == "2023-11-14T22:13:20Z"
+    assert second is first
+
+
 def test_health_check(client):
     """Test the health check endpoint."""
     response = client.get("/health")
@@ -147,6 +284,16 @@ def test_metrics_endpoint(client):
     assert "response_time_avg" in response.data.decode()
 
 
+def test_metrics_endpoint_by_endpoint(client):
+    """Test that per-endpoint counters are exposed to Prometheus."""
+    metrics.record_request("get_data", 0.01, True)
+    metrics.flush()
+
+    response = client.get("/metrics")
+    assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    assert 'requests_by_endpoint{endpoint="get_data"} 1\n' in response.data.decode()
+
+
 def test_metrics_json_endpoint(client):
     """Test the JSON metrics endpoint."""
     response = client.get("/metrics-json")
@@ -164,6 +311,8 @@ def test_api_data_endpoint(client):
     assert "message" in data
     assert "timestamp" in data
     assert "random_number" in data
+    assert data["timestamp"].endswith("Z")
+    assert response.mimetype == "application/json"
 
 
 def test_load_test_endpoint(client):
@@ -173,21 +322,42 @@ def test_load_test_endpoint(client):
     assert response.status_code in [200, 400, 500]
 
 
-def test_redis_requirement():
-    """Test that MetricsCollector fails fast when Redis is unavailable."""
-    with patch("app.redis_client", None):
-        with patch("app.get_redis_client", return_value=None):
-            # Reset singleton to force reinitialization
-            MetricsCollector._instance = None
+def test_exception_in_tracked_view_recorded_once(client):
+    """Test that an exception in a tracked view is counted as a single 500."""
+    with patch("app.random.randint", side_effect=ValueError("boom")):
+        response = client.get("/api/data")
+    metrics.flush()
+
+    assert response.status_code == 500
+    assert response.get_json()["type"] == "ValueError"
+    metrics_data = metrics.get_metrics()
+    assert metrics_data["requests_total"] == 1
+    assert metrics_data["errors_total"] == 1
+    assert metrics_data["errors_500"] == 1
+    assert metrics_data["endpoint_metrics"] == {"get_data": 1}
+
+
+def test_access_log(client):
+    """Test that responses are written to the access log."""
+    with patch.object(app_module.access_logger, "info") as log_info:
+        client.get("/metrics-json")
+
+    log_info.assert_called_once()
+    args = log_info.call_args.args
+    assert args[1:4] == ("GET", "/metrics-json", 200)
+
 
-            # Should raise RuntimeError when Redis is unavailable
-            with pytest.raises(RuntimeError, match="Redis is required but unavailable"):
-                MetricsCollector()
+def test_redis_unreachable():
+    """Test that MetricsCollector fails fast when Redis cannot be reached."""
+    unreachable = MagicMock()
+    unreachable.exists.side_effect = redis.ConnectionError("Connection refused")
+    with patch("app.redis_client", unreachable):
+        with pytest.raises(RuntimeError, match="Redis is required but unavailable"):
+            MetricsCollector()
 
 
 def test_redis_only_storage_type():
     """Test that metrics always report 'redis' storage type."""
-    metrics = MetricsCollector()
     metrics_data = metrics.get_metrics()
     assert metrics_data["storage_type"] == "redis"
 